@@ -14,7 +14,9 @@ module Config
     region: ENV['AWS_REGION'] || 'us-east-1',
     lambda_function: ENV['LAMBDA_FUNCTION'] || 'ken-burns-video-generator-go',
     s3_bucket: ENV['S3_BUCKET'] || 'burns-videos',
-    s3_lifecycle_days: ENV['S3_LIFECYCLE_DAYS'] || 14
+    s3_lifecycle_days: ENV['S3_LIFECYCLE_DAYS'] || 14,
+    # Upper bound on concurrent segment Lambda invocations per project
+    lambda_max_concurrency: (ENV['LAMBDA_MAX_CONCURRENCY'] || 25).to_i
   }
 
   # Image Service Configuration
@@ -8,6 +8,8 @@ require_relative 'lib/services/s3_service'
 require_relative 'lib/services/local_video_service'
 require 'fileutils'
 require 'json'
+require 'open3'
+require 'concurrent'
 
 if ARGV.empty?
   puts "❌ Usage: #{$0} <project_id>"
@@ -41,25 +43,34 @@ begin
   segments_dir = "segments/#{project_id}"
   FileUtils.mkdir_p(segments_dir)
   
-  downloaded_count = 0
-  (0...manifest['segments'].length).each do |i|
-    segment_key = "segments/#{project_id}/#{i}_segment.mp4"
-    local_path = "#{segments_dir}/#{i}_segment.mp4"
-    
-    begin
-      s3_service.instance_variable_get(:@s3_client).get_object(
-        bucket: 'burns-videos',
-        key: segment_key,
-        response_target: local_path
-      )
-      downloaded_count += 1
-      puts "  ✅ Downloaded segment #{i}" if i % 10 == 0
-    rescue => e
-      # Skip missing segments
-      puts "  ⚠️  Segment #{i} not available"
+  # Segment downloads are independent, so fetch them on a small thread pool
+  s3_client = s3_service.instance_variable_get(:@s3_client)
+  executor = Concurrent::FixedThreadPool.new(16)
+  
+  futures = (0...manifest['segments'].length).map do |i|
+    Concurrent::Future.execute(executor: executor) do
+      segment_key = "segments/#{project_id}/#{i}_segment.mp4"
+      local_path = "#{segments_dir}/#{i}_segment.mp4"
+      
+      begin
+        s3_client.get_object(
+          bucket: 'burns-videos',
+          key: segment_key,
+          response_target: local_path
+        )
+        puts "  ✅ Downloaded segment #{i}" if i % 10 == 0
+        true
+      rescue => e
+        # Skip missing segments
+        puts "  ⚠️  Segment #{i} not available"
+        false
+      end
     end
   end
   
+  downloaded_count = futures.map(&:value).count(true)
+  executor.shutdown
+  
   puts "📊 Downloaded #{downloaded_count} segment files"
   
   if downloaded_count < (manifest['segments'].length * 0.5)
@@ -72,37 +83,36 @@ begin
   
   segment_files = (0...manifest['segments'].length).map { |i| "#{segments_dir}/#{i}_segment.mp4" }.select { |f| File.exist?(f) }
   
-  # Create FFmpeg concat file
-  concat_file = "/tmp/#{project_id}_segments.txt"
-  File.open(concat_file, 'w') do |f|
-    segment_files.each { |file| f.puts "file '#{File.absolute_path(file)}'" }
-  end
-  
-  # Combine segments
-  temp_video = "/tmp/#{project_id}_segments_combined.mp4"
-  cmd = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", concat_file, "-c", "copy", "-y", temp_video]
-  
-  puts "🔧 Combining segments..."
-  unless system(*cmd)
-    puts "❌ Failed to combine segments"
-    exit 1
-  end
+  # FFmpeg concat list, fed on stdin; entries need the file: protocol, or they
+  # resolve against the pipe: URL
+  concat_list = segment_files.map { |file| "file 'file:#{File.absolute_path(file)}'\n" }.join
   
-  # Add audio
+  # Combine segments and add audio in a single pass
   audio_file = "#{project_id}.m4a"
   final_video = "completed/#{project_id}_ken_burns_video.mp4"
   
   FileUtils.mkdir_p("completed")
   
-  audio_cmd = [
-    "ffmpeg", "-i", temp_video, "-i", audio_file,
-    "-c:v", "copy", "-c:a", "aac", "-map", "0:v:0", "-map", "1:a:0",
-    "-shortest", "-y", final_video
+  # AAC audio (the usual .m4a) muxes in as-is; anything else is encoded once
+  audio_codec = begin
+    Open3.capture2(
+      "ffprobe", "-v", "error", "-select_streams", "a:0",
+      "-show_entries", "stream=codec_name", "-of", "csv=p=0", audio_file,
+      err: File::NULL
+    ).first
+  rescue SystemCallError
+    ""
+  end
+  cmd = [
+    "ffmpeg", "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe", "-i", "pipe:0", "-i", audio_file,
+    "-c:v", "copy", "-c:a", audio_codec.strip == "aac" ? "copy" : "aac", "-map", "0:v:0", "-map", "1:a:0",
+    "-shortest", "-movflags", "+faststart", "-y", final_video
   ]
   
-  puts "🎵 Adding audio..."
-  unless system(*audio_cmd)
-    puts "❌ Failed to add audio"
+  puts "🔧 Combining segments with audio..."
+  _output, status = Open3.capture2(*cmd, stdin_data: concat_list)
+  unless status.success?
+    puts "❌ Failed to combine segments with audio"
     exit 1
   end
   
@@ -115,17 +125,14 @@ begin
     # Upload to S3
     puts "📤 Uploading to S3..."
     s3_key = "projects/#{project_id}/final_video.mp4"
-    s3_service.instance_variable_get(:@s3_client).put_object(
-      bucket: 'burns-videos',
-      key: s3_key,
-      body: File.read(final_video),
-      content_type: 'video/mp4'
+    # Multipart upload in parallel 8MB parts rather than one PUT of the whole file held in memory
+    s3_service.instance_variable_get(:@s3_resource).bucket('burns-videos').object(s3_key).upload_file(
+      final_video,
+      content_type: 'video/mp4',
+      multipart_threshold: 8 * 1024 * 1024,
+      thread_count: 10
     )
     puts "✅ Uploaded to S3: s3://burns-videos/#{s3_key}"
-    
-    # Cleanup
-    [concat_file, temp_video].each { |f| File.delete(f) if File.exist?(f) }
-    
   else
     puts "❌ Failed to create final video"
     exit 1
@@ -5,26 +5,148 @@
 
 set -e
 
-# Basic debug output
-echo "DEBUG: Bash script starting" >&2
-echo "DEBUG: Current directory: $(pwd)" >&2
-echo "DEBUG: Files in current directory:" >&2
-ls -la >&2
+# The bootstrap captures stdout and stderr as one stream (CombinedOutput) and
+# parses it as the JSON response, so nothing else may reach that pipe. When
+# both share a pipe, diagnostics go to the bootstrap's own stderr, which is
+# CloudWatch, or nowhere if that cannot be opened.
+if [ -p /dev/stdout ] && [ /dev/stdout -ef /dev/stderr ]; then
+    if [ -w "/proc/$PPID/fd/2" ] && [ ! /dev/stdout -ef "/proc/$PPID/fd/2" ]; then
+        exec 2>> "/proc/$PPID/fd/2"
+    else
+        exec 2> /dev/null
+    fi
+fi
+
+# Startup diagnostics, only when BOOTSTRAP_DEBUG is set
+if [ -n "${BOOTSTRAP_DEBUG:-}" ]; then
+    printf 'DEBUG: Bash script starting\nDEBUG: Current directory: %s\nDEBUG: Files in current directory:\n%s\n' \
+        "$PWD" "$(ls -la)" >&2
+fi
 
 # Configuration
 BUCKET_NAME="${S3_BUCKET:-burns-videos}"
-TEMP_DIR="/tmp"
+S3_URI="s3://$BUCKET_NAME"
+# Scratch space: RAM-backed /dev/shm when the runtime provides a writable one
+# with at least SHM_MIN_FREE_MB (default 2048) free, else /tmp; TEMP_DIR
+# overrides. A segment needs only its own few MB here, but the combine step's
+# downloads, audio and final video hold the whole video twice over and a
+# small /dev/shm would fail the combine where /tmp has room.
+if [ -z "${TEMP_DIR:-}" ]; then
+    TEMP_DIR="/tmp"
+    if [ -d /dev/shm ] && [ -w /dev/shm ]; then
+        { read -r _; read -r _ _ _ shm_free_kb _; } < <(df -Pk /dev/shm 2>/dev/null) || shm_free_kb=0
+        if [ "${shm_free_kb:-0}" -ge $((${SHM_MIN_FREE_MB:-2048} * 1024)) ] &&
+            mkdir -p /dev/shm/ken_burns 2>/dev/null; then
+            TEMP_DIR="/dev/shm/ken_burns"
+        fi
+    fi
+fi
 DEFAULT_FPS=24
 DEFAULT_RESOLUTION="1920x1080"
+CPU_COUNT="$(nproc 2>/dev/null || echo 2)"
+
+# Unmatched globs expand to nothing rather than the literal pattern
+shopt -s nullglob
+
+# Keep tool output to errors only so the bootstrap is not pumping progress chatter.
+# -nostdin stops ffmpeg polling stdin for interactive keys.
+FFMPEG_QUIET=(-hide_banner -nostats -loglevel error -nostdin)
 
-# Logging function
+# H.264 encoder: libx264, or NVENC when ENABLE_HW_ENCODE=1 and this ffmpeg
+# build can actually open it (listed encoders may lack a usable GPU). The probe
+# result is cached in /tmp, which a warm Lambda keeps between invocations, so
+# only a cold start pays for it.
+VIDEO_ENCODER=libx264
+if [ "${ENABLE_HW_ENCODE:-0}" = "1" ]; then
+    encoder_cache="/tmp/.ken_burns_video_encoder"
+    if [ -s "$encoder_cache" ]; then
+        read -r VIDEO_ENCODER < "$encoder_cache" || true
+    else
+        if ffmpeg "${FFMPEG_QUIET[@]}" -encoders 2>/dev/null | grep -q h264_nvenc &&
+            ffmpeg "${FFMPEG_QUIET[@]}" -f lavfi -i color=c=black:s=256x256:d=0.1 -c:v h264_nvenc -f null - 2>/dev/null; then
+            VIDEO_ENCODER=h264_nvenc
+        fi
+        echo "$VIDEO_ENCODER" > "$encoder_cache" 2>/dev/null || true
+    fi
+    unset encoder_cache
+fi
+case "$VIDEO_ENCODER" in
+    h264_nvenc) VIDEO_ENCODER_ARGS=(-c:v h264_nvenc -preset p4 -cq 23 -b:v 0) ;;
+    *) VIDEO_ENCODER=libx264
+       VIDEO_ENCODER_ARGS=(-c:v libx264 -preset veryfast -tune stillimage -crf 23 -x264-params ref=1) ;;
+esac
+# Stream layout shared by every encode, whichever encoder is used
+VIDEO_STREAM_ARGS=(-profile:v high -level 4.1 -pix_fmt yuv420p
+    -g $((DEFAULT_FPS * 2)) -keyint_min $DEFAULT_FPS -sc_threshold 0)
+
+# Log level from LOG_LEVEL: DEBUG, INFO (default), WARN or ERROR
+case "${LOG_LEVEL:-INFO}" in
+    DEBUG) LOG_THRESHOLD=0 ;;
+    WARN|WARNING) LOG_THRESHOLD=2 ;;
+    ERROR) LOG_THRESHOLD=3 ;;
+    *) LOG_THRESHOLD=1 ;;
+esac
+
+# Logging functions - stderr, so stdout carries nothing but the JSON response.
+# printf's %(...)T formats the timestamp without forking date.
 log() {
-    echo "[$(date '+%Y-%m-%d %H:%M:%S')] $1"
+    [ "$LOG_THRESHOLD" -le 1 ] || return 0
+    printf '[%(%Y-%m-%d %H:%M:%S)T] %s\n' -1 "$1" >&2
+}
+
+warn() {
+    [ "$LOG_THRESHOLD" -le 2 ] || return 0
+    printf '[%(%Y-%m-%d %H:%M:%S)T] WARNING: %s\n' -1 "$1" >&2
+}
+
+debug_enabled() {
+    [ "$LOG_THRESHOLD" -eq 0 ]
+}
+
+debug() {
+    debug_enabled || return 0
+    printf '[%(%Y-%m-%d %H:%M:%S)T] DEBUG: %s\n' -1 "$1" >&2
+}
+
+# Record the scratch choice, and what /dev/shm offered when it was considered
+if [ -n "${shm_free_kb:-}" ]; then
+    log "Scratch dir: $TEMP_DIR (/dev/shm: ${shm_free_kb}KB free, ${SHM_MIN_FREE_MB:-2048}MB required)"
+else
+    log "Scratch dir: $TEMP_DIR"
+fi
+unset shm_free_kb
+
+# Free space in $TEMP_DIR in KB, from a single df call
+tmp_free_kb() {
+    local avail
+    { read -r _; read -r _ _ _ avail _; } < <(df -Pk "$TEMP_DIR")
+    echo "$avail"
+}
+
+# Temp files created while handling the current event
+TEMP_FILES=()
+
+# Register temp paths for cleanup_temp_files
+track_temp() {
+    TEMP_FILES+=("$@")
+}
+
+# Remove exactly the tracked temp files and directories instead of globbing $TEMP_DIR
+cleanup_temp_files() {
+    [ ${#TEMP_FILES[@]} -eq 0 ] || rm -rf "${TEMP_FILES[@]}"
+    TEMP_FILES=()
+}
+
+# Stop a background job started under set -m, along with the commands it
+# spawned, by signalling its whole process group; a finished one is left alone
+stop_job() {
+    kill -- -"$1" 2>/dev/null || return 0
+    wait "$1" 2>/dev/null || true
 }
 
 # Error handling
 error_exit() {
-    log "ERROR: $1"
+    printf '[%(%Y-%m-%d %H:%M:%S)T] ERROR: %s\n' -1 "$1" >&2
     exit 1
 }
 
@@ -34,90 +156,96 @@ download_s3_file() {
     local local_path="$2"
     
     log "Downloading from S3: $s3_key"
-    aws s3 cp "s3://$BUCKET_NAME/$s3_key" "$local_path" || return 1
-    log "Downloaded: $local_path"
+    aws s3 cp --only-show-errors "$S3_URI/$s3_key" "$local_path" || return 1
+    debug "Downloaded: $local_path"
 }
 
-# Upload file to S3
+# Download several objects under one S3 prefix with a single CLI process,
+# so they share its connection pool instead of each paying startup and TLS
+download_s3_files() {
+    local s3_prefix="$1"
+    local local_dir="$2"
+    shift 2
+    
+    local name includes=()
+    for name in "$@"; do
+        includes+=(--include "$name")
+    done
+    
+    log "Downloading $# files from S3: $s3_prefix"
+    aws s3 cp --only-show-errors --recursive "$S3_URI/$s3_prefix" "$local_dir" \
+        --exclude '*' "${includes[@]}" || return 1
+    debug "Downloaded $# files to: $local_dir"
+}
+
+# Upload file to S3. Files over 8 MB go up as parallel multipart parts;
+# the CLI's defaults already do that, so only the content type is set here.
 upload_s3_file() {
     local local_path="$1"
     local s3_key="$2"
+    local content_type="${3:-video/mp4}"
     
     log "Uploading to S3: $s3_key"
-    aws s3 cp "$local_path" "s3://$BUCKET_NAME/$s3_key" || return 1
-    log "Uploaded: $s3_key"
+    aws s3 cp --only-show-errors --content-type "$content_type" "$local_path" "$S3_URI/$s3_key" || return 1
+    debug "Uploaded: $s3_key"
 }
 
-# Download image from URL
-download_image() {
-    local url="$1"
-    local local_path="$2"
-    
-    log "Downloading image: $url"
-    curl -L -o "$local_path" "$url" || return 1
-    log "Downloaded image: $local_path"
-}
-
-# Generate Ken Burns video from image with variety of effects
+# Generate Ken Burns video from an image read on stdin, with variety of effects
 generate_ken_burns_video() {
-    local input_image="$1"
-    local output_video="$2"
-    local duration="$3"
+    local output_video="$1"
+    local duration="$2"
     
-    log "Generating Ken Burns video: $input_image -> $output_video"
+    log "Generating Ken Burns video: $output_video"
     
     # Check available memory before processing
-    local available_mem=$(df /tmp | tail -1 | awk '{print $4}')
-    log "Available /tmp space before processing: ${available_mem}KB"
+    if debug_enabled; then
+        debug "Available $TEMP_DIR space before processing: $(tmp_free_kb)KB"
+    fi
     
     # Get random Ken Burns effect
     local ken_burns_filter=$(get_random_ken_burns_effect "$duration")
     
+    # Each effect is "scale=<oversize>,crop=<motion>": upscale the still once,
+    # then loop that frame so only the crop and final downscale run per frame
+    local oversize="${ken_burns_filter%%,*}"
+    local motion="${ken_burns_filter#*,}"
+    
     # Create ultra-smooth Ken Burns effect with memory-optimized settings
     # Reduced quality for memory efficiency while maintaining smoothness
-    local frame_count=$((duration * DEFAULT_FPS))
-    
     # Use faster preset and higher CRF to reduce memory usage
-    ffmpeg -i "$input_image" \
+    # The still arrives as a single piped frame; the loop filter repeats it at
+    # the output rate so the crop expressions see a real t per frame.
+    # The per-frame rescale is mostly a mild shrink, where area averaging is
+    # much cheaper than lanczos (it falls back to bilinear when enlarging);
+    # lanczos stays on the one-off oversize scale. The scalers are slice-threaded
+    # across every vCPU the function's memory size grants. The JPEG's
+    # full-range yuvj420p is converted to the encoder's yuv420p on the one-off
+    # scale, so the looped frames need no per-frame pixel format conversion.
+    ffmpeg "${FFMPEG_QUIET[@]}" -f image2pipe -framerate $DEFAULT_FPS -i pipe:0 \
+        -filter_complex_threads "$CPU_COUNT" \
         -filter_complex "
-        $ken_burns_filter,
-        scale=$DEFAULT_RESOLUTION:flags=lanczos
+        $oversize,
+        format=yuv420p,
+        loop=loop=-1:size=1:start=0,
+        $motion,
+        scale=$DEFAULT_RESOLUTION:flags=area
         " \
         -t "$duration" \
         -fps_mode cfr \
         -r $DEFAULT_FPS \
-        -c:v libx264 \
-        -preset fast \
-        -crf 23 \
-        -profile:v high \
-        -level 4.1 \
-        -pix_fmt yuv420p \
-        -g $((DEFAULT_FPS * 2)) \
-        -keyint_min $DEFAULT_FPS \
-        -sc_threshold 0 \
-        -movflags +faststart \
-        -threads 2 \
+        "${VIDEO_ENCODER_ARGS[@]}" \
+        "${VIDEO_STREAM_ARGS[@]}" \
+        -threads "$CPU_COUNT" \
         -y "$output_video" || return 1
-    
-    # Immediately verify file was created and log size
-    if [ -f "$output_video" ]; then
-        local video_size=$(stat -f%z "$output_video" 2>/dev/null || echo "unknown")
-        log "Generated video: $output_video (${video_size} bytes)"
-    else
-        log "ERROR: Video file was not created: $output_video"
-        return 1
-    fi
 }
 
 # Get random Ken Burns effect for variety
 get_random_ken_burns_effect() {
     local duration="$1"
-    local frames=$((duration * DEFAULT_FPS))
     
     # ULTRA-SMOOTH KEN BURNS EFFECTS - Complete rewrite using scale/crop approach
     # NEW APPROACH: Use time-based interpolation instead of incremental zoom
     # This provides perfectly smooth motion without jitter
-    local total_frames=$((duration * DEFAULT_FPS))
     
     local effects=(
         # 1. Ultra-smooth zoom in from center using time-based interpolation
@@ -173,34 +301,50 @@ get_random_ken_burns_effect() {
 }
 
 # Combine videos with audio
+# Usage: combine_videos_with_audio audio_file output_video segment_file...
 combine_videos_with_audio() {
-    local video_list="$1"
-    local audio_file="$2"
-    local output_video="$3"
+    local audio_file="$1"
+    local output_video="$2"
+    shift 2
+    local segment_files=("$@")
     
     log "Combining videos with audio"
     
-    # Combine videos first
-    local combined_video="$TEMP_DIR/combined_video.mp4"
-    log "Combining videos with FFmpeg..."
-    ffmpeg -f concat -safe 0 -i "$video_list" -c copy -y "$combined_video" || return 1
-    
-    # Immediately cleanup segment files after combination to free space
-    log "Cleaning up segment files after combination..."
-    rm -f "$TEMP_DIR"/segment_*_segment.mp4
-    
-    # Add audio if available
+    # Concatenate and add the audio in one pass, so the video is written once
+    local audio_args=()
     if [ -f "$audio_file" ]; then
-        log "Adding audio to combined video..."
-        ffmpeg -i "$combined_video" -i "$audio_file" -c:v copy -c:a aac -shortest -y "$output_video" || return 1
-        log "Added audio to video"
-        
-        # Remove intermediate combined video after audio is added
-        rm -f "$combined_video"
+        # AAC sources go into the MP4 untouched; anything else is encoded once
+        local audio_codec=aac
+        [ "$(get_audio_codec "$audio_file")" != "aac" ] || audio_codec=copy
+        audio_args=(-i "$audio_file" -map 0:v:0 -map 1:a:0 -c:a "$audio_codec" -shortest)
     else
-        mv "$combined_video" "$output_video"
+        log "No audio file, combining video only"
     fi
     
+    # Segments are stream-copied when they all came from the same encoder. With
+    # ENABLE_HW_ENCODE, NVENC segments can meet libx264 ones (a container
+    # without a usable GPU, or LambdaService's local fallback), and those
+    # cannot share one H.264 track, so the video is re-encoded instead.
+    local video_args=(-c:v copy)
+    if [ "${ENABLE_HW_ENCODE:-0}" = "1" ] && ! same_video_encoder "${segment_files[@]}"; then
+        log "Segments come from different encoders, re-encoding the video"
+        video_args=("${VIDEO_ENCODER_ARGS[@]}" "${VIDEO_STREAM_ARGS[@]}" -threads "$CPU_COUNT")
+    fi
+    
+    # The concat list goes in on stdin rather than through a temp file. Entries
+    # carry an explicit file: protocol; bare paths would resolve against the
+    # list's own pipe: URL.
+    # faststart puts the index up front so the final video can play while it
+    # downloads; it is only worth its rewrite here, not on every segment.
+    log "Combining videos with FFmpeg..."
+    printf "file 'file:%s'\n" "${segment_files[@]}" |
+        ffmpeg "${FFMPEG_QUIET[@]}" -f concat -safe 0 -protocol_whitelist file,pipe -i pipe:0 \
+            "${audio_args[@]}" "${video_args[@]}" -movflags +faststart -y "$output_video" || return 1
+    
+    # Cleanup segment files as soon as they are combined to free space
+    log "Cleaning up segment files after combination..."
+    [ ${#segment_files[@]} -eq 0 ] || rm -f "${segment_files[@]}"
+    
     log "Final video: $output_video"
 }
 
@@ -210,6 +354,47 @@ get_video_duration() {
     ffprobe -v quiet -show_entries format=duration -of csv=p=0 "$video_path" 2>/dev/null || echo "0"
 }
 
+# Succeeds when every given video's stream carries the same encoder tag
+# (e.g. "Lavc61.3.100 libx264"); a file that cannot be probed counts as different
+same_video_encoder() {
+    local file encoder first
+    for file in "$@"; do
+        encoder=$(ffprobe -v quiet -select_streams v:0 -show_entries stream_tags=encoder -of csv=p=0 "$file" 2>/dev/null) || return 1
+        first="${first-$encoder}"
+        [ "$encoder" = "$first" ] || return 1
+    done
+}
+
+# Total of the given durations in seconds; fails if any is missing
+sum_durations() {
+    printf '%s\n' "$@" | awk '$1 == "" { missing = 1 } { total += $1 } END { if (missing) exit 1; printf "%.3f\n", total }'
+}
+
+# Get the codec of a file's first audio stream (e.g. aac, mp3)
+get_audio_codec() {
+    local audio_path="$1"
+    ffprobe -v quiet -select_streams a:0 -show_entries stream=codec_name -of csv=p=0 "$audio_path" 2>/dev/null || true
+}
+
+# Read the project manifest and download the audio track it references.
+# The manifest streams straight into jq; only the audio key is kept.
+fetch_project_audio() {
+    local project_id="$1"
+    local audio_file="$2"
+    
+    local manifest_key="projects/$project_id/manifest.json"
+    local audio_s3_key
+    log "Reading manifest from S3: $manifest_key"
+    # audio_file is either the key itself or S3Service's upload result hash
+    audio_s3_key=$(set -o pipefail
+        aws s3 cp --only-show-errors "$S3_URI/$manifest_key" - |
+            ./jq -r '.audio_file | if type == "object" then .s3_key else . end // empty') || return 1
+    
+    if [ -n "$audio_s3_key" ]; then
+        download_s3_file "$audio_s3_key" "$audio_file" || warn "Could not download audio file"
+    fi
+}
+
 # Main processing function
 process_segment() {
     local project_id="$1"
@@ -219,33 +404,48 @@ process_segment() {
     
     log "Processing segment: $segment_id"
     
+    # Runs in its own subshell, so this also cleans up when error_exit fires
+    trap cleanup_temp_files EXIT
+    
     # Parse images JSON and download first image
-    local first_image_url=$(echo "$images_json" | ./jq -r '.[0].url // empty')
+    local first_image_url=$(./jq -r '.[0].url // empty' <<< "$images_json")
     if [ -z "$first_image_url" ]; then
         error_exit "No images found for segment $segment_id"
     fi
     
-    # Download image
-    local image_path="$TEMP_DIR/segment_${segment_id}_image.jpg"
-    download_image "$first_image_url" "$image_path" || error_exit "Failed to download image"
-    
-    # Generate video
+    # Stream the image straight into ffmpeg instead of staging it in /tmp.
+    # The encoded segment is written to a file and uploaded once ffmpeg has
+    # succeeded, so the segment key, which LambdaService treats as a finished
+    # segment, never holds a partial video. A few MB in /tmp is far cheaper
+    # than the extra AWS CLI launches a streamed upload needs to stay safe.
     local video_path="$TEMP_DIR/segment_${segment_id}_video.mp4"
-    generate_ken_burns_video "$image_path" "$video_path" "$duration" || error_exit "Failed to generate video"
+    track_temp "$video_path"
+    local statuses
+    log "Downloading image: $first_image_url"
+    set +e
+    curl -fsSL "$first_image_url" | generate_ken_burns_video "$video_path" "$duration"
+    statuses=("${PIPESTATUS[@]}")
+    set -e
+    if [ "${statuses[0]}" -ne 0 ] || [ "${statuses[1]}" -ne 0 ]; then
+        # curl exits 23 (write error), or dies of SIGPIPE, when ffmpeg quits
+        # reading first; that is ffmpeg's failure, not the download's
+        case "${statuses[0]}" in
+            0|23|141) error_exit "Failed to generate video" ;;
+            *) error_exit "Failed to download image" ;;
+        esac
+    fi
     
     # Upload segment video
     local s3_key="segments/$project_id/${segment_id}_segment.mp4"
     upload_s3_file "$video_path" "$s3_key" || error_exit "Failed to upload segment video"
     
     # Aggressive cleanup - remove files immediately after upload
-    rm -f "$image_path" "$video_path"
-    
-    # Also clean up any other temp files that might exist for this segment
-    rm -f "$TEMP_DIR/segment_${segment_id}_"*
+    cleanup_temp_files
     
-    # Log final memory status
-    local final_mem=$(df /tmp | tail -1 | awk '{print $4}')
-    log "Segment $segment_id completed. Available /tmp space: ${final_mem}KB"
+    log "Segment $segment_id completed"
+    if debug_enabled; then
+        debug "Available $TEMP_DIR space: $(tmp_free_kb)KB"
+    fi
     
     echo "{\"segment_id\":\"$segment_id\",\"segment_s3_key\":\"$s3_key\",\"duration\":$duration}"
 }
@@ -257,94 +457,139 @@ combine_segments() {
     
     log "Combining segments for project: $project_id (memory-efficient mode)"
     
+    # Runs in its own subshell, so this also cleans up when error_exit fires
+    trap cleanup_temp_files EXIT
+    
     # Check available disk space
-    local available_space=$(df /tmp | tail -1 | awk '{print $4}')
-    log "Available /tmp space: ${available_space}KB"
+    if debug_enabled; then
+        debug "Available $TEMP_DIR space: $(tmp_free_kb)KB"
+    fi
     
-    # Create video list file
-    local video_list="$TEMP_DIR/video_list.txt"
-    rm -f "$video_list"  # Ensure clean start
+    # Everything for this event lives in its own directory, so it never shares
+    # file names with a download left over from an earlier invocation that
+    # failed; a warm Lambda keeps /tmp between events
+    local work_dir
+    work_dir=$(mktemp -d "$TEMP_DIR/combine_XXXXXX") || error_exit "Failed to create work directory"
+    track_temp "$work_dir"
     
-    # Process segments in batches to avoid memory issues
-    local batch_size=10  # Process 10 segments at a time
     local segment_count=0
-    local batch_files=()
-    local final_parts=()
     
-    # Count total segments first
-    local total_segments=$(echo "$segments_json" | ./jq -r '.[] | .segment_s3_key' | wc -l)
+    # Fetch manifest and audio in the background while segments download.
+    # set -m gives the job its own process group, so an early error_exit can
+    # stop it and its aws child before the work directory is removed.
+    local audio_file="$work_dir/audio.mp3"
+    set -m
+    fetch_project_audio "$project_id" "$audio_file" < /dev/null &
+    local audio_pid=$!
+    set +m
+    trap 'stop_job "$audio_pid"; cleanup_temp_files' EXIT
+    
+    # Collect segment keys and durations once, two lines per segment
+    local segment_fields
+    mapfile -t segment_fields < <(./jq -r '.[] | (.segment_s3_key // ""), (.duration // "")' <<< "$segments_json")
+    local total_segments=$((${#segment_fields[@]} / 2))
     log "Total segments to process: $total_segments"
     
-    # Process segments in batches
-    echo "$segments_json" | ./jq -r '.[] | .segment_s3_key' | while read s3_key; do
-        if [ -n "$s3_key" ]; then
-            local video_path="$TEMP_DIR/segment_$(basename "$s3_key" .mp4).mp4"
-            
-            # Download segment video
-            if download_s3_file "$s3_key" "$video_path"; then
-                echo "file '$video_path'" >> "$video_list"
-                segment_count=$((segment_count + 1))
-                
-                # Log progress every 10 segments
-                if [ $((segment_count % 10)) -eq 0 ]; then
-                    log "Downloaded $segment_count/$total_segments segments"
-                    # Check remaining disk space
-                    local remaining_space=$(df /tmp | tail -1 | awk '{print $4}')
-                    log "Remaining /tmp space: ${remaining_space}KB"
-                fi
-            else
-                log "Warning: Failed to download $s3_key, skipping"
+    # Work out local paths up front so the concat list keeps segment order.
+    # Segments are grouped by S3 prefix (normally just segments/<project_id>/),
+    # each prefix landing in its own directory.
+    local j s3_key prefix
+    local video_keys=() video_paths=() video_durations=() prefixes=() prefix_dirs=()
+    for ((j = 0; j < ${#segment_fields[@]}; j += 2)); do
+        s3_key="${segment_fields[$j]}"
+        [ -n "$s3_key" ] || continue
+        prefix=""
+        [[ "$s3_key" != */* ]] || prefix="${s3_key%/*}/"
+        
+        local p=0
+        while [ "$p" -lt ${#prefixes[@]} ] && [ "${prefixes[$p]}" != "$prefix" ]; do
+            p=$((p + 1))
+        done
+        if [ "$p" -eq ${#prefixes[@]} ]; then
+            prefixes+=("$prefix")
+            prefix_dirs+=("$work_dir/segments_$p")
+        fi
+        
+        video_keys+=("$s3_key")
+        video_paths+=("${prefix_dirs[$p]}/${s3_key##*/}")
+        video_durations+=("${segment_fields[$j + 1]}")
+    done
+    
+    # One CLI process per prefix downloads all of its segments concurrently.
+    # Keys at the bucket root are fetched one by one instead, since a recursive
+    # copy there would list the whole bucket.
+    local i name names pids=()
+    for p in "${!prefixes[@]}"; do
+        names=()
+        for i in "${!video_keys[@]}"; do
+            if [ "${video_paths[$i]%/*}" == "${prefix_dirs[$p]}" ]; then
+                names+=("${video_keys[$i]##*/}")
             fi
+        done
+        if [ -n "${prefixes[$p]}" ]; then
+            download_s3_files "${prefixes[$p]}" "${prefix_dirs[$p]}" "${names[@]}" &
+            pids+=($!)
+        else
+            mkdir -p "${prefix_dirs[$p]}"
+            for name in "${names[@]}"; do
+                download_s3_file "$name" "${prefix_dirs[$p]}/$name" &
+                pids+=($!)
+            done
         fi
     done
+    [ ${#pids[@]} -eq 0 ] || wait "${pids[@]}" || true
     
-    # Check if we have any segments
-    local downloaded_count=$(wc -l < "$video_list" 2>/dev/null || echo "0")
-    if [ "$downloaded_count" -eq 0 ]; then
-        error_exit "No segment videos successfully downloaded"
+    if debug_enabled; then
+        debug "Remaining $TEMP_DIR space: $(tmp_free_kb)KB"
     fi
     
-    log "Successfully downloaded $downloaded_count segment videos"
+    # Build the concat list from the downloads that landed
+    local combined_paths=() combined_durations=()
+    for i in "${!video_paths[@]}"; do
+        if [ -s "${video_paths[$i]}" ]; then
+            combined_paths+=("${video_paths[$i]}")
+            combined_durations+=("${video_durations[$i]}")
+            segment_count=$((segment_count + 1))
+        else
+            warn "Failed to download ${video_keys[$i]}, skipping"
+        fi
+    done
     
-    # Download audio file
-    local audio_file="$TEMP_DIR/audio.mp3"
-    local manifest_key="projects/$project_id/manifest.json"
-    local manifest_path="$TEMP_DIR/manifest.json"
+    # Check if we have any segments
+    if [ "$segment_count" -eq 0 ]; then
+        error_exit "No segment videos successfully downloaded"
+    fi
     
-    download_s3_file "$manifest_key" "$manifest_path" || error_exit "Failed to download manifest"
-    local audio_s3_key=$(./jq -r '.audio_file // empty' "$manifest_path")
+    log "Successfully downloaded $segment_count segment videos"
     
-    if [ -n "$audio_s3_key" ]; then
-        download_s3_file "$audio_s3_key" "$audio_file" || log "Warning: Could not download audio file"
-    fi
+    wait "$audio_pid" || error_exit "Failed to download manifest"
     
     # Combine videos
-    local final_video="$TEMP_DIR/final_video.mp4"
-    combine_videos_with_audio "$video_list" "$audio_file" "$final_video" || error_exit "Failed to combine videos"
+    local final_video="$work_dir/final_video.mp4"
+    combine_videos_with_audio "$audio_file" "$final_video" "${combined_paths[@]}" || error_exit "Failed to combine videos"
     
     # Upload final video
     local final_s3_key="videos/${project_id}_final_video.mp4"
     upload_s3_file "$final_video" "$final_s3_key" || error_exit "Failed to upload final video"
     
-    # Get video duration
-    local duration=$(get_video_duration "$final_video")
+    # Report the final video's own length: -shortest trims it to the audio and
+    # each segment is rounded to whole frames, so the segment results' sum can
+    # be off. The sum only stands in when ffprobe cannot read the file.
+    local duration
+    duration=$(get_video_duration "$final_video")
+    case "$duration" in
+        ""|0|N/A) duration=$(sum_durations "${combined_durations[@]}") || duration=0 ;;
+    esac
     
     # Aggressive cleanup to free memory
     log "Cleaning up temporary files..."
-    
-    # Remove video list and manifest
-    rm -f "$video_list" "$audio_file" "$manifest_path"
-    
-    # Remove all segment videos (they're no longer needed)
-    rm -f "$TEMP_DIR"/segment_*_segment.mp4
-    
-    # Remove any other temp files
-    find "$TEMP_DIR" -name "segment_*" -type f -delete 2>/dev/null || true
+    cleanup_temp_files
     
     # Log final cleanup status
-    local remaining_files=$(ls -la "$TEMP_DIR" | wc -l)
-    local final_space=$(df /tmp | tail -1 | awk '{print $4}')
-    log "Cleanup complete: $remaining_files files remaining, ${final_space}KB available"
+    if debug_enabled; then
+        local remaining=("$TEMP_DIR"/*)
+        debug "Cleanup complete: ${#remaining[@]} files remaining, $(tmp_free_kb)KB available"
+    fi
     
     log "Video combination completed"
     echo "{\"video_s3_key\":\"$final_s3_key\",\"duration\":$duration,\"resolution\":\"$DEFAULT_RESOLUTION\",\"fps\":$DEFAULT_FPS}"
@@ -355,35 +600,23 @@ main() {
     local event="$1"
     
     log "Starting Ken Burns video generation"
-    log "Event: $event"
-    log "Event length: ${#event}"
-    log "First 100 chars: ${event:0:100}"
-    
-    # Debug jq binary
-    log "Checking jq binary..."
-    if [ -f "./jq" ]; then
-        log "jq binary exists"
-        if [ -x "./jq" ]; then
-            log "jq binary is executable"
-        else
-            log "jq binary is NOT executable"
-        fi
-    else
-        log "jq binary does not exist"
-    fi
-    
-    # Parse event
-    local project_id=$(echo "$event" | ./jq -r '.project_id // empty')
-    local segment_id=$(echo "$event" | ./jq -r '.segment_id // empty')
-    local images_json=$(echo "$event" | ./jq -r '.images // empty')
-    local duration=$(echo "$event" | ./jq -r '.duration // 5.0')
-    local segments_json=$(echo "$event" | ./jq -r '.segment_results // empty')
-    
-    log "Parsed values:"
-    log "  project_id: '$project_id'"
-    log "  segment_id: '$segment_id'"
-    log "  duration: '$duration'"
-    log "  images_json length: ${#images_json}"
+    debug "Event length: ${#event}"
+    
+    # Parse event in a single jq pass, one field per line
+    local fields
+    mapfile -t fields < <(./jq -r '
+        (.project_id // ""),
+        (.segment_id // ""),
+        (.images // "" | if type == "string" then . else tojson end),
+        (.duration // 5.0),
+        (.segment_results // "" | if type == "string" then . else tojson end)' <<< "$event")
+    local project_id="${fields[0]:-}"
+    local segment_id="${fields[1]:-}"
+    local images_json="${fields[2]:-}"
+    local duration="${fields[3]:-5.0}"
+    local segments_json="${fields[4]:-}"
+    
+    debug "Parsed values: project_id='$project_id' segment_id='$segment_id' duration='$duration' images_json length=${#images_json}"
     
     if [ -z "$project_id" ]; then
         error_exit "project_id is required"
@@ -403,12 +636,12 @@ main() {
     fi
 }
 
-# Always read from stdin (called by Python bootstrap)
-log "Reading from stdin..."
-stdin_content=""
-while IFS= read -r line; do
-    log "STDIN: $line"
-    stdin_content+="$line"
-done
-event="$stdin_content"
+# The bootstrap hands the event over in LAMBDA_EVENT (its stdin is /dev/null);
+# EVENT_JSON does the same for other callers. Without either, slurp stdin with
+# a single read instead of a per-line loop.
+event="${LAMBDA_EVENT:-${EVENT_JSON:-}}"
+if [ -z "$event" ]; then
+    debug "Reading from stdin..."
+    IFS= read -r -d '' event || true
+fi
 main "$event" 
\ No newline at end of file
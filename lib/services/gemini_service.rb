@@ -2,7 +2,6 @@ require 'net/http'
 require 'json'
 require 'securerandom'
 require 'digest'
-require 'pry'
 
 class GeminiService
   GEMINI_API_BASE = 'https://generativelanguage.googleapis.com/v1beta'
@@ -3,7 +3,11 @@ require 'aws-sdk-s3'
 require 'json'
 require 'concurrent'
 require 'timeout'
+require 'net/http'
+require 'uri'
+require 'tempfile'
 require_relative '../../config/services'
+require_relative 'local_video_service'
 
 class LambdaService
   def initialize(region = nil)
@@ -13,17 +17,31 @@ class LambdaService
       credentials: Aws::Credentials.new(
         Config::AWS_CONFIG[:access_key_id],
         Config::AWS_CONFIG[:secret_access_key]
-      )
+      ),
+      # RequestResponse invokes hold the socket open for the whole run (up to the 900s Lambda cap);
+      # the SDK's 60s default read timeout would drop and re-invoke long segments
+      http_read_timeout: 905
     )
     @function_name = Config::AWS_CONFIG[:lambda_function]
+    @max_concurrency = Config::AWS_CONFIG[:lambda_max_concurrency]
     @s3_client = Aws::S3::Client.new(
       region: @region,
       credentials: Aws::Credentials.new(
         Config::AWS_CONFIG[:access_key_id],
         Config::AWS_CONFIG[:secret_access_key]
-      )
+      ),
+      # Parallel part uploads can hit S3's per-prefix request rate; adaptive
+      # retries back off client-side instead of failing the transfer
+      retry_mode: 'adaptive',
+      max_attempts: 5,
+      # Keep pooled connections open across segment-to-segment gaps so they
+      # are reused instead of paying a new TLS handshake
+      http_idle_timeout: 15
     )
     @bucket_name = Config::AWS_CONFIG[:s3_bucket]
+    # Built on the first local fallback and shared by the rest, so ffmpeg
+    # lookup and encoder detection run once rather than per segment
+    @local_video_service = Concurrent::Delay.new { LocalVideoService.new }
   end
 
   # Generate Ken Burns video for a project
@@ -222,8 +240,7 @@ class LambdaService
     
     begin
       # Use the local video service for fallback
-      require_relative 'local_video_service'
-      local_service = LocalVideoService.new
+      local_service = @local_video_service.value!
       
       # Get the first image URL from segment data
       images = segment_data[:images] || []
@@ -239,16 +256,13 @@ class LambdaService
       duration = segment_data[:duration] || 5.0
       
       # Download image to temp location
-      require 'net/http'
-      require 'uri'
-      require 'tempfile'
-      
       temp_image = Tempfile.new(['segment_image', '.jpg'])
       uri = URI(first_image_url)
       
       Net::HTTP.start(uri.host, uri.port, use_ssl: uri.scheme == 'https') do |http|
-        response = http.get(uri.path)
-        temp_image.write(response.body)
+        http.request_get(uri.request_uri) do |response|
+          response.read_body { |chunk| temp_image.write(chunk) }
+        end
         temp_image.flush
       end
       
@@ -256,23 +270,24 @@ class LambdaService
       temp_video = Tempfile.new(['segment_video', '.mp4'])
       temp_video.close
       
-      # Generate Ken Burns video locally
+      # Generate Ken Burns video locally, encoded like the Lambda segments it joins
       success = local_service.create_single_image_ken_burns(
         temp_image.path,
         duration,
-        temp_video.path
+        temp_video.path,
+        encoder_args: LocalVideoService::LAMBDA_ENCODER_ARGS
       )
       
       if success && File.exist?(temp_video.path)
         # Upload to S3
         s3_key = "segments/#{project_id}/#{segment_data[:segment_id]}_segment.mp4"
         
-        require_relative 's3_service'
-        s3_service = S3Service.new
-        s3_service.instance_variable_get(:@s3_client).put_object(
-          bucket: Config::AWS_CONFIG[:s3_bucket],
-          key: s3_key,
-          body: File.read(temp_video.path)
+        # Stream from disk, switching to parallel 8MB parts for larger files
+        Aws::S3::Object.new(@bucket_name, s3_key, client: @s3_client).upload_file(
+          temp_video.path,
+          content_type: 'video/mp4',
+          multipart_threshold: 8 * 1024 * 1024,
+          thread_count: 10
         )
         
         # Clean up
@@ -651,9 +666,10 @@ class LambdaService
       
       if retries < max_retries && retryable_error?(e)
         retries += 1
-        backoff_seconds = calculate_backoff_time(retries)
+        # Retry a one-off failure straight away; only back off once failures repeat or AWS is throttling
+        backoff_seconds = retries == 1 && !throttling_error?(e) ? 0 : calculate_backoff_time(retries)
         puts "    🔄 Retry #{retries}/#{max_retries} for segment #{segment_id} in #{backoff_seconds}s (#{e.message})"
-        sleep(backoff_seconds)
+        sleep(backoff_seconds) if backoff_seconds > 0
         
         # Modify payload for retry (simplify Ken Burns effect to reduce complexity)
         if retries >= 2
@@ -701,6 +717,13 @@ class LambdaService
     retryable_patterns.any? { |pattern| error_message.match?(pattern) }
   end
   
+  # Check if an error is AWS rate limiting, which always needs a backoff
+  # @param error [Exception] The error to check
+  # @return [Boolean] True if the request was throttled
+  def throttling_error?(error)
+    error.message.to_s.match?(/throttl|toomanyrequests/i)
+  end
+  
   # Check if a result contains a retryable error
   # @param result [Hash] The result to check
   # @return [Boolean] True if error is retryable
@@ -766,24 +789,12 @@ class LambdaService
   # @return [String] Presigned URL
   def generate_presigned_url(s3_key)
     begin
-      require_relative 's3_service'
-      s3_service = S3Service.new
-      bucket_name = Config::AWS_CONFIG[:s3_bucket]
-      
-      # Use S3 client to generate presigned URL
-      s3_client = Aws::S3::Client.new(
-        region: @region,
-        credentials: Aws::Credentials.new(
-          Config::AWS_CONFIG[:access_key_id],
-          Config::AWS_CONFIG[:secret_access_key]
-        )
-      )
-      
-      presigner = Aws::S3::Presigner.new(client: s3_client)
-      presigner.presigned_url(:get_object, bucket: bucket_name, key: s3_key, expires_in: 3600)
+      # Reuse the service's S3 client instead of building one per invocation
+      @presigner ||= Aws::S3::Presigner.new(client: @s3_client)
+      @presigner.presigned_url(:get_object, bucket: @bucket_name, key: s3_key, expires_in: 3600)
     rescue => e
       puts "    ⚠️ Failed to generate presigned URL: #{e.message}"
-      "s3://#{Config::AWS_CONFIG[:s3_bucket]}/#{s3_key}"
+      "s3://#{@bucket_name}/#{s3_key}"
     end
   end
 
@@ -797,7 +808,7 @@ class LambdaService
     # Handle edge case of 0 segments
     return 1 if segment_count <= 0
     
-    if segment_count <= 15
+    concurrency = if segment_count <= 15
       # Small projects: process all segments concurrently for speed
       segment_count
     elsif segment_count <= 60
@@ -807,6 +818,10 @@ class LambdaService
       # Large projects: balanced approach
       [segment_count, 20].min  # Increased from 10 to 20
     end
+    
+    # Account-level Lambda concurrency and S3 request rates are shared, so
+    # never go past the configured cap
+    concurrency.clamp(1, [@max_concurrency, 1].max)
   end
 
   # Check if segment video already exists in S3
@@ -844,7 +859,8 @@ class LambdaService
       
       # Parse response
       puts "    Debug - Response status: #{response.status_code}"
-      response_body = JSON.parse(response.payload.read)
+      raw_payload = response.payload.read
+      response_body = JSON.parse(raw_payload)
       puts "    Debug - Response body keys: #{response_body.keys.join(', ')}"
       
       if response.status_code == 200
@@ -899,7 +915,7 @@ class LambdaService
       
     rescue JSON::ParserError => e
       puts "    ❌ JSON parsing error: #{e.message}"
-      puts "    ❌ Raw response: #{response.payload.read}"
+      puts "    ❌ Raw response: #{raw_payload}"
       {
         success: false,
         error: "Invalid JSON response from Lambda: #{e.message}"
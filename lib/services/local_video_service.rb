@@ -1,17 +1,40 @@
 require 'json'
 require 'fileutils'
 require 'open3'
+require 'net/http'
+require 'uri'
 require 'tempfile'
+require 'time'
+require 'concurrent'
 
 # Local video generation service
 # This replaces the Lambda-based video generation for faster development
 class LocalVideoService
+  # Hardware H.264 encoders to try, in order of preference, before falling back to libx264
+  HARDWARE_ENCODERS = %w[h264_videotoolbox h264_nvenc].freeze
+  # Concurrent image downloads, shared by all segments being generated
+  IMAGE_DOWNLOAD_WORKERS = 16
+  # Keep ffmpeg to error messages only; run_ffmpeg shows them when a command fails
+  FFMPEG_QUIET_ARGS = %w[-hide_banner -nostats -loglevel error].freeze
+  # libx264 settings of the Lambda renderer (ken_burns_video_generator.sh). Segments
+  # rendered here in place of a Lambda one must match them, as the final video
+  # stream-copies every segment into one H.264 stream. A Lambda running NVENC
+  # (ENABLE_HW_ENCODE) re-encodes instead when its segments' encoders differ.
+  LAMBDA_ENCODER_ARGS = %w[-c:v libx264 -preset veryfast -tune stillimage -crf 23 -x264-params ref=1].freeze
+
   def initialize
     @temp_dir = Dir.mktmpdir
+    @temp_files = Concurrent::Set.new # Files created in @temp_dir, removed by cleanup_temp_files
     @ffmpeg_path = find_ffmpeg
+    @ffprobe_path = find_ffprobe
+    @video_encoder = detect_video_encoder
+    # Renders run as separate ffmpeg processes, each threading internally, hence half the cores
+    @segment_workers = [Concurrent.processor_count / 2, 1].max
+    @ffmpeg_threads = ffmpeg_threads_per_invocation
     puts "🎬 Local Video Service initialized"
     puts "  📁 Temp directory: #{@temp_dir}"
     puts "  🎥 FFmpeg path: #{@ffmpeg_path}"
+    puts "  ⚙️  Video encoder: #{@video_encoder} (#{@ffmpeg_threads} threads x #{@segment_workers} segments)"
   end
 
   # Generate Ken Burns video from project data
@@ -120,43 +143,53 @@ class LocalVideoService
   # @param image_path [String] Path to the image file
   # @param duration [Float] Duration in seconds
   # @param output_path [String] Path for the output video
+  # @param encoder_args [Array<String>] Encoder arguments, defaulting to the detected encoder's
   # @return [Boolean] Success status
-  def create_single_image_ken_burns(image_path, duration, output_path)
+  def create_single_image_ken_burns(image_path, duration, output_path, encoder_args: video_encoder_args)
     # Get random Ken Burns effect for variety
     ken_burns_filter = get_random_ken_burns_effect(duration)
     
+    # Each effect is "scale=<oversize>,crop=<motion>": upscale the still once,
+    # then loop that frame so only the crop and final downscale run per frame.
+    # Converting to yuv420p before the loop keeps the pixel format conversion
+    # out of the per-frame path.
+    oversize, motion = ken_burns_filter.split(",", 2)
+    
     # Ultra-smooth Ken Burns with highest quality settings
     # NEW APPROACH: Direct scale/crop with time-based interpolation
     # This eliminates the jittery motion from the old zoompan approach
     filter_complex = [
-      "[0:v]#{ken_burns_filter},",
+      "[0:v]#{oversize},",
+      "format=yuv420p,",
+      "loop=loop=-1:size=1:start=0,",
+      "#{motion},",
       "scale=1920:1080:flags=lanczos[v]"
     ].join
     
     cmd = [
       @ffmpeg_path,
+      "-framerate", "24",   # Frame duration for the looped still, so the crop animates over t
       "-i", image_path,
+      "-filter_complex_threads", @ffmpeg_threads.to_s,
       "-filter_complex", filter_complex,
       "-map", "[v]",
       "-t", duration.to_s,
       "-fps_mode", "cfr",   # Constant frame rate mode (replaces vsync)
       "-r", "24",           # Explicit frame rate
-      "-c:v", "libx264",
-      "-preset", "slower",  # Higher quality encoding
-      "-crf", "16",         # Lower CRF for higher quality
+      *encoder_args,
+      "-threads", @ffmpeg_threads.to_s, # Share the cores with the other concurrent renders
       "-profile:v", "high",
       "-level", "4.1",
       "-pix_fmt", "yuv420p",
       "-g", "48",           # GOP size (2 seconds at 24fps)
       "-keyint_min", "24",  # Minimum keyframe interval
       "-sc_threshold", "0", # Disable scene cut detection
-      "-movflags", "+faststart",
       "-y", # Overwrite output
       output_path
     ]
     
     puts "    🎥 Creating ultra-smooth Ken Burns effect: #{File.basename(output_path)}"
-    system(*cmd)
+    run_ffmpeg(cmd)
   end
 
   private
@@ -170,19 +203,17 @@ class LocalVideoService
     # Download audio file
     audio_file = download_audio_file(manifest['audio_file'])
     
-    # Download images for each segment
-    segments_with_images = []
-    manifest['segments'].each_with_index do |segment, index|
+    # Collect segment details; images are fetched per segment as it is rendered
+    segments = manifest['segments'].map do |segment|
       # Ensure segment keys are strings
       segment = segment.transform_keys(&:to_s) if segment.is_a?(Hash)
       
-      segment_images = download_segment_images(segment['generated_images'])
-      segments_with_images << {
+      {
         id: segment['id'],
         start_time: segment['start_time'].to_f,
         end_time: segment['end_time'].to_f,
         text: segment['text'],
-        images: segment_images,
+        image_data: segment['generated_images'],
         duration: segment['end_time'].to_f - segment['start_time'].to_f
       }
     end
@@ -190,7 +221,7 @@ class LocalVideoService
     {
       project_id: project_id,
       audio_file: audio_file,
-      segments: segments_with_images
+      segments: segments
     }
   end
 
@@ -198,7 +229,7 @@ class LocalVideoService
     # Handle case where audio_s3_key might be a Hash or other type
     audio_path = audio_s3_key.is_a?(String) ? audio_s3_key : 'sad.m4a'
     
-    local_path = File.join(@temp_dir, "audio#{File.extname(audio_path)}")
+    local_path = temp_path("audio#{File.extname(audio_path)}")
     
     # For now, assume the audio file is already local
     # In a real implementation, you'd download from S3
@@ -214,74 +245,105 @@ class LocalVideoService
     local_path
   end
 
-  def download_segment_images(image_data_array)
-    images = []
-    
+  def download_segment_images(image_data_array, prefix = "")
     # Handle case where image_data_array might be nil or not an array
-    return images unless image_data_array.is_a?(Array)
+    return [] unless image_data_array.is_a?(Array)
     
-    image_data_array.each_with_index do |image_data, index|
-      # Ensure image_data is a hash with string keys
-      image_data = image_data.transform_keys(&:to_s) if image_data.is_a?(Hash)
-      
-      # Try to download the actual image from the URL
-      image_path = download_image_from_url(image_data['url'], index)
-      
-      if image_path && File.exist?(image_path)
-        images << {
-          path: image_path,
-          query: image_data['query'] || "image_#{index}",
-          provider: image_data['provider'] || 'downloaded'
-        }
-        puts "      ✅ Downloaded image #{index + 1}: #{image_data['url']}"
-      else
-        # Fallback to placeholder if download fails
-        placeholder_path = create_placeholder_image(image_data['url'] || "placeholder_#{index}", index)
-        images << {
-          path: placeholder_path,
-          query: image_data['query'] || "image_#{index}",
-          provider: image_data['provider'] || 'placeholder'
-        }
-        puts "      ⚠️  Failed to download image #{index + 1}, using placeholder"
+    # Fetch all of the segment's images at once rather than one round trip at a time
+    futures = image_data_array.each_with_index.map do |image_data, index|
+      Concurrent::Future.execute(executor: @download_executor || :io) do
+        download_segment_image(image_data, index, prefix)
       end
     end
     
-    images
+    # Results keep the images' order
+    futures.map(&:value!)
   end
 
-  def download_image_from_url(url, index)
+  def download_segment_image(image_data, index, prefix)
+    # Ensure image_data is a hash with string keys
+    image_data = image_data.transform_keys(&:to_s) if image_data.is_a?(Hash)
+    
+    # Try to download the actual image from the URL
+    image_path = download_image_from_url(image_data['url'], index, prefix)
+    
+    if image_path && File.exist?(image_path)
+      puts "      ✅ Downloaded image #{index + 1}: #{image_data['url']}"
+      {
+        path: image_path,
+        query: image_data['query'] || "image_#{index}",
+        provider: image_data['provider'] || 'downloaded'
+      }
+    else
+      # Fallback to placeholder if download fails
+      placeholder_path = create_placeholder_image(image_data['url'] || "placeholder_#{index}", index, prefix)
+      puts "      ⚠️  Failed to download image #{index + 1}, using placeholder"
+      {
+        path: placeholder_path,
+        query: image_data['query'] || "image_#{index}",
+        provider: image_data['provider'] || 'placeholder'
+      }
+    end
+  end
+
+  def download_image_from_url(url, index, prefix = "")
     return nil unless url && url.is_a?(String) && url.start_with?('http')
     
     begin
-      require 'net/http'
-      require 'uri'
-      
       # Parse URL and download image
       uri = URI.parse(url)
-      response = Net::HTTP.get_response(uri)
+      output_path = nil
       
-      if response.is_a?(Net::HTTPSuccess)
+      http_connection(uri).request_get(uri.request_uri) do |response|
+        next unless response.is_a?(Net::HTTPSuccess)
+        
         # Determine file extension from URL or content type
         extension = get_image_extension(url, response['content-type'])
-        output_path = File.join(@temp_dir, "downloaded_image_#{index}#{extension}")
+        output_path = temp_path("#{prefix}downloaded_image_#{index}#{extension}")
         
-        # Save the image
+        # Stream the image to disk rather than buffering the whole body
         File.open(output_path, 'wb') do |file|
-          file.write(response.body)
-        end
-        
-        # Verify the image is valid
-        if File.exist?(output_path) && File.size(output_path) > 0
-          return output_path
+          response.read_body { |chunk| file.write(chunk) }
         end
       end
+      
+      # Verify the image is valid
+      if output_path && File.exist?(output_path) && File.size(output_path) > 0
+        return output_path
+      end
     rescue => e
+      close_http_connection(uri) if uri
       puts "      ❌ Error downloading image #{index + 1}: #{e.message}"
     end
     
     nil
   end
 
+  # Keep-alive connection to the URI's host, one per thread since Net::HTTP
+  # is not thread-safe. Download pool threads are long-lived, so later images
+  # from the same host skip the TCP and TLS handshake.
+  def http_connection(uri)
+    connections = Thread.current[:local_video_service_http] ||= {}
+    key = [uri.scheme, uri.host, uri.port]
+    http = connections[key]
+    return http if http&.started?
+    
+    http = Net::HTTP.new(uri.host, uri.port)
+    http.use_ssl = uri.scheme == 'https'
+    http.keep_alive_timeout = 30
+    http.start
+    connections[key] = http
+  end
+
+  # Drop this thread's connection to the URI's host, e.g. after a failed request
+  def close_http_connection(uri)
+    connections = Thread.current[:local_video_service_http] or return
+    http = connections.delete([uri.scheme, uri.host, uri.port])
+    http.finish if http&.started?
+  rescue IOError
+    nil
+  end
+
   def get_image_extension(url, content_type)
     # Try to get extension from URL first
     if url.include?('.')
@@ -307,28 +369,40 @@ class LocalVideoService
   end
 
   def generate_segments(project_data)
-    puts "🎬 Generating #{project_data[:segments].length} video segments..."
-    
-    segment_videos = []
-    
-    project_data[:segments].each_with_index do |segment, index|
-      puts "  📹 Processing segment #{index + 1}/#{project_data[:segments].length}"
-      
-      segment_video = generate_segment_video(segment)
-      segment_videos << segment_video if segment_video
+    segments = project_data[:segments]
+    puts "🎬 Generating #{segments.length} video segments..."
+    
+    # Each task downloads one segment's images and then renders it, so one
+    # segment's downloads overlap another's encode
+    executor = Concurrent::FixedThreadPool.new(@segment_workers)
+    # Separate pool for image downloads, so segment tasks never wait on their own pool
+    @download_executor = Concurrent::FixedThreadPool.new(IMAGE_DOWNLOAD_WORKERS)
+    
+    futures = segments.each_with_index.map do |segment, index|
+      Concurrent::Future.execute(executor: executor) do
+        puts "  📹 Processing segment #{index + 1}/#{segments.length}"
+        generate_segment_video(segment)
+      end
     end
     
-    segment_videos
+    # value! re-raises a segment's error, and results keep segment order
+    futures.map(&:value!).compact
+  ensure
+    executor&.shutdown
+    @download_executor&.shutdown
+    @download_executor = nil
   end
 
   def generate_segment_video(segment)
-    return nil if segment[:images].empty?
+    # File names carry the segment id, since segments download concurrently
+    images = download_segment_images(segment[:image_data], "segment_#{segment[:id]}_")
+    return nil if images.empty?
     
     # Create a simple video with Ken Burns effect
-    output_path = File.join(@temp_dir, "segment_#{segment[:id]}.mp4")
+    output_path = temp_path("segment_#{segment[:id]}.mp4")
     
     # Use FFmpeg to create a video with zoom/pan effect
-    create_ken_burns_video(segment[:images], segment[:duration], output_path)
+    create_ken_burns_video(images, segment[:duration], output_path)
     
     output_path
   end
@@ -408,49 +482,39 @@ class LocalVideoService
     
     return nil if segment_videos.empty?
     
-    # Create a file list for concatenation
-    file_list_path = File.join(@temp_dir, "file_list.txt")
-    File.open(file_list_path, 'w') do |f|
-      segment_videos.each do |video_path|
-        f.puts "file '#{video_path}'"
-      end
+    # File list for the concat demuxer, fed on stdin rather than via a temp file.
+    # Entries need the file: protocol, or they resolve against the pipe: URL.
+    file_list = segment_videos.map { |video_path| "file 'file:#{File.absolute_path(video_path)}'\n" }.join
+    
+    # Concatenate and add the audio, if available, in one pass
+    audio_args = []
+    if audio_file && File.exist?(audio_file)
+      audio_args = [
+        "-i", audio_file,
+        "-map", "0:v:0",
+        "-map", "1:a:0",
+        "-c:a", audio_codec(audio_file) == "aac" ? "copy" : "aac", # AAC muxes as-is
+        "-shortest"
+      ]
     end
     
-    # Combine videos
-    combined_video_path = File.join(@temp_dir, "combined_video.mp4")
+    final_video_path = temp_path("final_video.mp4")
     
     cmd = [
       @ffmpeg_path,
       "-f", "concat",
       "-safe", "0",
-      "-i", file_list_path,
-      "-c", "copy",
+      "-protocol_whitelist", "file,pipe",
+      "-i", "pipe:0",
+      *audio_args,
+      "-c:v", "copy",
+      "-movflags", "+faststart", # Playable before fully downloaded; segments skip it
       "-y",
-      combined_video_path
+      final_video_path
     ]
     
-    system(*cmd)
-    
-    # Add audio if available
-    if audio_file && File.exist?(audio_file)
-      final_video_path = File.join(@temp_dir, "final_video.mp4")
-      
-      cmd = [
-        @ffmpeg_path,
-        "-i", combined_video_path,
-        "-i", audio_file,
-        "-c:v", "copy",
-        "-c:a", "aac",
-        "-shortest",
-        "-y",
-        final_video_path
-      ]
-      
-      system(*cmd)
-      final_video_path
-    else
-      combined_video_path
-    end
+    run_ffmpeg(cmd, stdin_data: file_list)
+    final_video_path
   end
 
   def move_to_completed_folder(video_path, project_id)
@@ -472,10 +536,10 @@ class LocalVideoService
     completed_path
   end
 
-  def create_placeholder_image(url, index)
+  def create_placeholder_image(url, index, prefix = "")
     # Create a simple colored rectangle as placeholder
     width, height = 1920, 1080
-    output_path = File.join(@temp_dir, "placeholder_#{index}.jpg")
+    output_path = temp_path("#{prefix}placeholder_#{index}.jpg")
     
     # Create a colored rectangle using ImageMagick or similar
     # For now, create a simple text-based image
@@ -492,7 +556,7 @@ class LocalVideoService
     ]
     
     puts "      🎨 Creating placeholder image #{index + 1}: #{color} (#{width}x#{height})"
-    system(*cmd)
+    run_ffmpeg(cmd)
     output_path
   end
 
@@ -507,7 +571,7 @@ class LocalVideoService
       output_path
     ]
     
-    system(*cmd)
+    run_ffmpeg(cmd)
     output_path
   end
 
@@ -515,30 +579,119 @@ class LocalVideoService
     return 0 unless video_path && File.exist?(video_path)
     
     cmd = [
-      @ffmpeg_path,
-      "-i", video_path,
+      @ffprobe_path,
+      "-v", "error",
       "-show_entries", "format=duration",
-      "-v", "quiet",
-      "-of", "csv=p=0"
+      "-of", "csv=p=0",
+      video_path
+    ]
+    
+    output, _status = Open3.capture2(*cmd, err: File::NULL)
+    output.strip.to_f
+  rescue SystemCallError
+    0
+  end
+
+  # Run an ffmpeg command without its console chatter, printing what it
+  # reported only when it fails. Returns true on success.
+  def run_ffmpeg(cmd, stdin_data: nil)
+    ffmpeg, *args = cmd
+    output, status = Open3.capture2e(ffmpeg, *FFMPEG_QUIET_ARGS, *args, stdin_data: stdin_data)
+    
+    unless status.success?
+      puts "    ❌ FFmpeg failed (#{status.exitstatus}) writing #{File.basename(args.last.to_s)}"
+      output.each_line { |line| puts "      #{line}" }
+    end
+    
+    status.success?
+  end
+
+  # Pick the fastest H.264 encoder that actually works on this machine.
+  # Builds often list hardware encoders without a usable device, so each
+  # candidate is confirmed with a tiny test encode.
+  def detect_video_encoder
+    encoders, _status = Open3.capture2e(@ffmpeg_path, "-hide_banner", "-encoders")
+    
+    HARDWARE_ENCODERS.find { |encoder| encoders.include?(encoder) && encoder_usable?(encoder) } || "libx264"
+  rescue => e
+    puts "  ⚠️  Encoder detection failed, using libx264: #{e.message}"
+    "libx264"
+  end
+
+  def encoder_usable?(encoder)
+    cmd = [
+      @ffmpeg_path,
+      "-hide_banner", "-loglevel", "error",
+      "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1",
+      "-c:v", encoder,
+      "-f", "null", "-"
     ]
     
-    duration = `#{cmd.join(' ')}`.strip.to_f
-    duration
+    _output, status = Open3.capture2e(*cmd)
+    status.success?
+  end
+
+  # Threads per ffmpeg render: FFMPEG_THREADS_PER_INVOCATION if set (1-64),
+  # otherwise the cores split evenly across the concurrent segment renders
+  # so they don't oversubscribe the machine
+  def ffmpeg_threads_per_invocation
+    threads = Integer(ENV['FFMPEG_THREADS_PER_INVOCATION'] || Concurrent.processor_count / @segment_workers, exception: false)
+    (threads || 1).clamp(1, 64)
+  end
+
+  # Encoder and rate-control arguments for the detected encoder
+  def video_encoder_args
+    case @video_encoder
+    when "h264_nvenc"
+      ["-c:v", "h264_nvenc", "-preset", "p5", "-tune", "hq", "-rc", "vbr", "-cq", "19", "-b:v", "0"]
+    when "h264_videotoolbox"
+      ["-c:v", "h264_videotoolbox", "-b:v", "12M"]
+    else
+      [
+        "-c:v", "libx264",
+        "-preset", "slower",  # Higher quality encoding
+        "-tune", "stillimage", # Source is a single photo panned smoothly
+        "-crf", "16",         # Lower CRF for higher quality
+        "-x264-params", "ref=1"
+      ]
+    end
+  end
+
+  # Codec of the first audio stream (e.g. "aac", "mp3"), or nil if unknown
+  def audio_codec(audio_path)
+    cmd = [
+      @ffprobe_path,
+      "-v", "error",
+      "-select_streams", "a:0",
+      "-show_entries", "stream=codec_name",
+      "-of", "csv=p=0",
+      audio_path
+    ]
+    
+    output, status = Open3.capture2(*cmd, err: File::NULL)
+    status.success? ? output.strip : nil
+  rescue SystemCallError
+    nil
   end
 
   def find_ffmpeg
-    # Try to find ffmpeg in PATH
-    ffmpeg_paths = ['ffmpeg', '/usr/local/bin/ffmpeg', '/opt/homebrew/bin/ffmpeg']
+    # Try to find ffmpeg in PATH, then in the usual install locations
+    path_dirs = ENV.fetch('PATH', '').split(File::PATH_SEPARATOR)
+    ffmpeg_paths = path_dirs.map { |dir| File.join(dir, 'ffmpeg') } + ['/usr/local/bin/ffmpeg', '/opt/homebrew/bin/ffmpeg']
     
     ffmpeg_paths.each do |path|
-      if system("which #{path} > /dev/null 2>&1")
-        return path
-      end
+      return path if File.file?(path) && File.executable?(path)
     end
     
     raise "FFmpeg not found. Please install FFmpeg to generate videos."
   end
 
+  # ffprobe normally ships alongside ffmpeg; otherwise leave it to the PATH lookup
+  def find_ffprobe
+    sibling = File.join(File.dirname(@ffmpeg_path), "ffprobe")
+    File.file?(sibling) && File.executable?(sibling) ? sibling : "ffprobe"
+  end
+
   def download_segments_from_s3(project_id)
     # This would download segment info from S3 - for now return empty
     # In a real implementation, we'd check S3 for available segments
@@ -547,7 +700,7 @@ class LocalVideoService
 
   def download_project_audio(project_id)
     # Download the project's audio file from S3
-    audio_path = File.join(@temp_dir, "audio.mp3")
+    audio_path = temp_path("audio.mp3")
     
     # Try common audio file locations
     audio_keys = [
@@ -597,7 +750,22 @@ class LocalVideoService
     "projects/#{project_id}/final_video.mp4"
   end
 
+  # Path in the temp dir, recorded so cleanup_temp_files removes it. The dir
+  # is recreated if an earlier cleanup removed it, so the service can be reused.
+  def temp_path(name)
+    FileUtils.mkdir_p(@temp_dir)
+    path = File.join(@temp_dir, name)
+    @temp_files << path
+    path
+  end
+
+  # Remove only the files this service created, then the temp dir itself once
+  # nothing is left in it; segments placed there by the caller keep it alive
   def cleanup_temp_files
-    FileUtils.rm_rf(@temp_dir) if Dir.exist?(@temp_dir)
+    FileUtils.rm_f(@temp_files.to_a)
+    @temp_files.clear
+    Dir.rmdir(@temp_dir)
+  rescue Errno::ENOTEMPTY, Errno::ENOENT
+    nil
   end
 end 
\ No newline at end of file
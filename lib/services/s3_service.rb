@@ -1,6 +1,6 @@
 require 'aws-sdk-s3'
 require 'json'
-require 'pry'
+require 'securerandom'
 require_relative '../../config/services'
 
 class S3Service
@@ -11,7 +11,14 @@ class S3Service
       credentials: Aws::Credentials.new(
         Config::AWS_CONFIG[:access_key_id],
         Config::AWS_CONFIG[:secret_access_key]
-      )
+      ),
+      # Parallel part uploads can hit S3's per-prefix request rate; adaptive
+      # retries back off client-side instead of failing the transfer
+      retry_mode: 'adaptive',
+      max_attempts: 5,
+      # Keep pooled connections open across segment-to-segment gaps so they
+      # are reused instead of paying a new TLS handshake
+      http_idle_timeout: 15
     )
     @s3_resource = Aws::S3::Resource.new(client: @s3_client)
   end
@@ -59,9 +66,10 @@ class S3Service
       # Download image from URL
       image_content = download_image_from_url(image_data[:url])
       
-      # Generate S3 key
+      # Generate S3 key; the random suffix keeps images for the same query
+      # uploaded within one second from overwriting each other
       timestamp = Time.now.strftime('%Y%m%d_%H%M%S')
-      filename = "#{image_data[:query].gsub(/\s+/, '_')}_#{timestamp}.jpg"
+      filename = "#{image_data[:query].gsub(/\s+/, '_')}_#{timestamp}_#{SecureRandom.hex(4)}.jpg"
       s3_key = "#{prefix}/#{filename}"
       
       # Upload to S3
@@ -289,11 +297,7 @@ class S3Service
     puts "📤 Uploading audio file: #{File.basename(audio_file_path)}"
     
     begin
-      # Read audio file
-      audio_content = File.read(audio_file_path)
-      
       # Generate S3 key
-      timestamp = Time.now.strftime('%Y%m%d_%H%M%S')
       filename = File.basename(audio_file_path)
       s3_key = "projects/#{project_id}/audio/#{filename}"
       
@@ -301,9 +305,12 @@ class S3Service
       bucket = @s3_resource.bucket(bucket_name)
       obj = bucket.object(s3_key)
       
-      obj.put(
-        body: audio_content,
-        content_type: 'audio/mpeg'
+      # Stream from disk; long recordings go up as parallel 8MB parts
+      obj.upload_file(
+        audio_file_path,
+        content_type: 'audio/mpeg',
+        multipart_threshold: 8 * 1024 * 1024,
+        thread_count: 10
       )
       
       # Generate presigned URL for access
@@ -110,6 +110,9 @@ puts "📊 File size: #{(File.size(audio_file) / 1024.0 / 1024.0).round(2)} MB"
 puts "\n🚀 Initializing video generator..."
 generator = VideoGenerator.new
 
+# Setup is done: compact and promote the long-lived heap so GC during generation only scans new objects
+Process.warmup if Process.respond_to?(:warmup)
+
 # Generation options optimized for Ken Burns effect
 generation_options = {
   resolution: '1080p',
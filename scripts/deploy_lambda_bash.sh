@@ -148,6 +148,7 @@ cat > lambda-policy.json << EOF
             "Action": [
                 "s3:GetObject",
                 "s3:PutObject",
+                "s3:AbortMultipartUpload",
                 "s3:ListBucket"
             ],
             "Resource": [